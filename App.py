@@ -1,35 +1,131 @@
 import os
+import threading
+import time
 import uuid
+from dataclasses import dataclass
 import streamlit as st
 from dotenv import load_dotenv
-from openai import AzureOpenAI
 import opik
-from opik.integrations.openai import track_openai
 from opik import track
 
-# 1️⃣ Load environment variables first
-load_dotenv()
+# Only the system prompt plus the most recent turns are sent to the model;
+# the full transcript is kept in session state for display, up to a hard cap.
+MAX_HISTORY_TURNS = 6
+MAX_STORED_MESSAGES = 200
 
-# 2️⃣ Configure Opik (use cloud if local not running)
-opik.configure(
-    api_key=os.getenv("OPIK_API_KEY"),
-    workspace=os.getenv("OPIK_WORKSPACE"),
-    use_local=False  # Set True only if running a local Opik server
-)
+# Deterministic (temperature 0) replies are cached process-wide for an hour
+REPLY_CACHE_TTL = 3600
+REPLY_CACHE_SIZE = 512
 
-# 3️⃣ Initialize Azure OpenAI client with tracing
-azure_client = AzureOpenAI(
-    api_version=os.getenv("OPENAI_API_VERSION")
-)
-client = track_openai(azure_client)
 
-# 4️⃣ Streamlit UI setup...
+def _window(msgs):
+    """Return the system prompt, the new user prompt and the MAX_HISTORY_TURNS turns before it.
+
+    Always returns a new list: Opik serializes traced inputs later on its own
+    thread, after the session transcript has been appended to or trimmed.
+    """
+    return [msgs[0]] + msgs[max(1, len(msgs) - (2 * MAX_HISTORY_TURNS + 1)):]
+
+
+def _trim(msgs):
+    """Drop the oldest non-system turns once the transcript exceeds its cap."""
+    overflow = len(msgs) - MAX_STORED_MESSAGES
+    if overflow > 0:
+        # Round up to whole user/assistant pairs so msgs[1] stays a user message
+        overflow += overflow % 2
+        del msgs[1:overflow + 1]
+
+
+# 1️⃣ Load environment variables first (once per process)
+def _number_env(name, cast, default=None):
+    """Parse an optional numeric env var, naming the variable if it is malformed."""
+    raw = os.getenv(name, "").strip()
+    if not raw:
+        return default
+    try:
+        return cast(raw)
+    except ValueError:
+        raise ValueError(f"{name} must be a number, got {raw!r}") from None
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Environment configuration, read once per process."""
+    deployment_name: str | None
+    api_version: str | None
+    temperature: float  # replies are only cached at temperature 0
+    max_tokens: int | None  # None omits the parameter
+    prewarm: bool
+    opik_api_key: str | None
+    opik_workspace: str | None
+
+
+@st.cache_resource
+def get_settings():
+    # Parse .env once per process rather than on every Streamlit rerun
+    load_dotenv()
+    return Settings(
+        deployment_name=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
+        api_version=os.getenv("OPENAI_API_VERSION"),
+        temperature=_number_env("AZURE_OPENAI_TEMPERATURE", float, 0.7),
+        max_tokens=_number_env("AZURE_OPENAI_MAX_TOKENS", int) or None,
+        prewarm=os.getenv("AZURE_OPENAI_PREWARM", "1") != "0",
+        opik_api_key=os.getenv("OPIK_API_KEY"),
+        opik_workspace=os.getenv("OPIK_WORKSPACE"),
+    )
+
+
+# 2️⃣ Configure Opik and build the traced Azure OpenAI client once per process.
+# st.cache_resource shares the client (and its connection pool) across reruns
+# and sessions; per-user state such as thread_id stays in st.session_state.
+@st.cache_resource
+def get_client():
+    # Imported here so the page can paint before the openai SDK is loaded
+    from openai import AzureOpenAI
+    from opik.integrations.openai import track_openai
+
+    opik.configure(
+        api_key=settings.opik_api_key,
+        workspace=settings.opik_workspace,
+        use_local=False  # Set True only if running a local Opik server
+    )
+    azure_client = AzureOpenAI(
+        api_version=settings.api_version
+    )
+    if settings.prewarm and settings.deployment_name:
+        # with_options() copies the client but shares its connection pool, so the
+        # warm-up is not traced yet still leaves a live connection behind
+        warm_client = azure_client.with_options(max_retries=0)
+        threading.Thread(target=_warm, args=(warm_client,), daemon=True).start()
+    return track_openai(azure_client)
+
+
+def _warm(azure_client):
+    """Pay TLS, auth and deployment cold-start costs before the first prompt."""
+    try:
+        azure_client.chat.completions.create(
+            model=settings.deployment_name,
+            messages=[{"role": "user", "content": "."}],
+            max_tokens=1
+        )
+    except Exception:
+        pass
+
+# 3️⃣ Streamlit UI setup...
 st.set_page_config(page_title="Azure AI Agent with Opik Tracing", page_icon="🤖", layout="centered")
 st.title("🤖 Azure AI Agent with Real-time Tracing")
 st.caption("Built using Streamlit, Azure OpenAI, and Opik by Comet ML")
 st.sidebar.success("✅ Opik Tracing Active")
 
-# 5️⃣ Session state
+# 4️⃣ Initialize Azure OpenAI client with tracing
+try:
+    settings = get_settings()
+except ValueError as e:
+    st.error(f"Invalid configuration: {e}")
+    st.stop()
+client = get_client()
+
+# 5️⃣ Session state (messages are stored in the API's {"role", "content"} shape)
 if "messages" not in st.session_state:
     st.session_state.messages = [{"role": "system", "content": "You are a professional AI assistant."}]
 
@@ -46,13 +142,58 @@ for msg in st.session_state.messages:
 # 7️⃣ Chat input and response
 @track(name="generate_response", tags=["chat", "azure-openai"])
 def generate_response(prompt: str, messages: list):
-    response = client.chat.completions.create(
-        model=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
+    # Deployments that only accept max_completion_tokens reject max_tokens,
+    # so it is only sent when a cap is configured
+    limits = {"max_tokens": settings.max_tokens} if settings.max_tokens else {}
+    stream = client.chat.completions.create(
+        model=settings.deployment_name,
         messages=messages,
-        temperature=0.7,
-        opik_args={"trace": {"thread_id": st.session_state.thread_id}}
+        temperature=settings.temperature,
+        stream=True,
+        # Lets track_openai record token usage from the final chunk
+        stream_options={"include_usage": True},
+        opik_args={"trace": {"thread_id": st.session_state.thread_id}},
+        **limits
     )
-    return response.choices[0].message.content
+    # Azure may send chunks without choices (content filter results, usage)
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        if choice.finish_reason:
+            st.session_state.finish_reason = choice.finish_reason
+        if choice.delta.content:
+            yield choice.delta.content
+
+# The reply cache is shared by every session, so identical conversations from
+# different users are served from the same entry. It is keyed on the whole
+# outgoing conversation plus the deployment name, so switching models
+# invalidates it. Cache hits make no API call and are therefore not traced.
+@st.cache_resource
+def _reply_cache():
+    return {}, threading.Lock()
+
+
+def _cache_key(messages):
+    return settings.deployment_name, tuple((m["role"], m["content"]) for m in messages)
+
+
+def _cached_reply(key):
+    cache, lock = _reply_cache()
+    with lock:
+        entry = cache.get(key)
+    if entry and time.monotonic() - entry[0] < REPLY_CACHE_TTL:
+        return entry[1]
+    return None
+
+
+def _store_reply(key, reply):
+    cache, lock = _reply_cache()
+    with lock:
+        cache.pop(key, None)
+        cache[key] = (time.monotonic(), reply)
+        while len(cache) > REPLY_CACHE_SIZE:
+            del cache[next(iter(cache))]
 
 if prompt := st.chat_input("Ask the AI agent anything..."):
     st.session_state.messages.append({"role": "user", "content": prompt})
@@ -60,13 +201,21 @@ if prompt := st.chat_input("Ask the AI agent anything..."):
         st.markdown(prompt)
 
     with st.chat_message("assistant"):
-        with st.spinner("Thinking..."):
-            try:
-                reply = generate_response(
-                    prompt,
-                    [{"role": m["role"], "content": m["content"]} for m in st.session_state.messages]
-                )
+        try:
+            messages = _window(st.session_state.messages)
+            key = _cache_key(messages) if settings.temperature == 0 else None
+            reply = _cached_reply(key) if key else None
+            if reply is not None:
                 st.markdown(reply)
-                st.session_state.messages.append({"role": "assistant", "content": reply})
-            except Exception as e:
-                st.error(f"Error communicating with Azure OpenAI: {e}")
+            else:
+                st.session_state.finish_reason = None
+                reply = st.write_stream(generate_response(prompt, messages))
+                # Only complete answers are shared; empty, filtered or cut-off ones are not
+                if key and reply and st.session_state.finish_reason == "stop":
+                    _store_reply(key, reply)
+            st.session_state.messages.append({"role": "assistant", "content": reply})
+            _trim(st.session_state.messages)
+        except Exception as e:
+            # Drop the unanswered prompt so the transcript keeps alternating turns
+            st.session_state.messages.pop()
+            st.error(f"Error communicating with Azure OpenAI: {e}")